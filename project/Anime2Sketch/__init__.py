@@ -20,8 +20,6 @@ import torch.nn.functional as F
 from torchvision.transforms import ToTensor
 from .anime2sketch import UnetGenerator
 
-import pdb
-
 
 def create_model():
     """
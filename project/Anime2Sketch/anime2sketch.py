@@ -1,14 +1,26 @@
 import os
+import inspect
 import torch
 import torch.nn as nn 
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 import functools
-import pdb
+from typing import Optional
+
+_DEFAULT_WEIGHTS = os.path.join(os.path.dirname(__file__), "models/Anime2Sketch.pth")
+
+# normalized 3x3 blur of Smooth
+_SMOOTH_KERNEL = torch.tensor([[[[1, 2, 1], [2, 4, 2], [1, 2, 1]]]], dtype=torch.float) / 16.0
+# 2x bilinear upsample followed by the blur, as one 6x6 stride-2 deconv kernel
+_BILINEAR_KERNEL = torch.tensor([1.0, 3.0, 3.0, 1.0]) / 4.0
+_UPSAMPLE_KERNEL = F.conv2d(torch.outer(_BILINEAR_KERNEL, _BILINEAR_KERNEL).view(1, 1, 4, 4), _SMOOTH_KERNEL, padding=2)
 
 class UnetGenerator(nn.Module):
     """Create a Unet-based generator"""
 
-    def __init__(self, input_nc=3, output_nc=1, num_downs=8, ngf=64, norm_layer=nn.InstanceNorm2d, use_dropout=False):
+    def __init__(self, input_nc=3, output_nc=1, num_downs=8, ngf=64, norm_layer=nn.InstanceNorm2d, use_dropout=False,
+                 use_amp=False, use_compile=False, use_checkpoint=False,
+                 int8_calib_data=None, use_ipex=False):
         """Construct a Unet generator
         Parameters:
             input_nc (int)  -- the number of channels in input images
@@ -17,10 +29,16 @@ class UnetGenerator(nn.Module):
                                 image of size 128x128 will become of size 1x1 # at the bottleneck
             ngf (int)       -- the number of filters in the last conv layer
             norm_layer      -- normalization layer
+            use_amp (bool)  -- run the unet under autocast (float16 on cuda, bfloat16 on cpu), not for torch.jit.script
+            use_compile (bool) -- compile the unet for inference, see compile_inference()
+            use_checkpoint (bool) -- recompute unet blocks on backward to save activation memory in training
+            int8_calib_data -- input batches in [0, 1], if given convert the unet to int8 for cpu, see quantize()
+            use_ipex (bool) -- optimize for cpu bfloat16 with intel extension for pytorch, see optimize_ipex()
         We construct the U-Net from the innermost layer to the outermost layer.
         It is a recursive process.
         """
         super(UnetGenerator, self).__init__()
+        self.use_amp = use_amp
         # input_nc = 3
         # output_nc = 1
         # num_downs = 8
@@ -31,14 +49,14 @@ class UnetGenerator(nn.Module):
 
 
         # construct unet structure
-        unet_block = UnetSkipConnectionBlock(ngf * 8, ngf * 8, input_nc=None, submodule=None, norm_layer=norm_layer, innermost=True)  # add the innermost layer
+        unet_block = create_unet_block(ngf * 8, ngf * 8, input_nc=None, submodule=None, norm_layer=norm_layer, innermost=True, use_checkpoint=use_checkpoint)  # add the innermost layer
         for _ in range(num_downs - 5):          # add intermediate layers with ngf * 8 filters
-            unet_block = UnetSkipConnectionBlock(ngf * 8, ngf * 8, input_nc=None, submodule=unet_block, norm_layer=norm_layer, use_dropout=use_dropout)
+            unet_block = create_unet_block(ngf * 8, ngf * 8, input_nc=None, submodule=unet_block, norm_layer=norm_layer, use_dropout=use_dropout, use_checkpoint=use_checkpoint)
         # gradually reduce the number of filters from ngf * 8 to ngf
-        unet_block = UnetSkipConnectionBlock(ngf * 4, ngf * 8, input_nc=None, submodule=unet_block, norm_layer=norm_layer)
-        unet_block = UnetSkipConnectionBlock(ngf * 2, ngf * 4, input_nc=None, submodule=unet_block, norm_layer=norm_layer)
-        unet_block = UnetSkipConnectionBlock(ngf, ngf * 2, input_nc=None, submodule=unet_block, norm_layer=norm_layer)
-        self.model = UnetSkipConnectionBlock(output_nc, ngf, input_nc=input_nc, submodule=unet_block, outermost=True, norm_layer=norm_layer)  # add the outermost layer
+        unet_block = create_unet_block(ngf * 4, ngf * 8, input_nc=None, submodule=unet_block, norm_layer=norm_layer, use_checkpoint=use_checkpoint)
+        unet_block = create_unet_block(ngf * 2, ngf * 4, input_nc=None, submodule=unet_block, norm_layer=norm_layer, use_checkpoint=use_checkpoint)
+        unet_block = create_unet_block(ngf, ngf * 2, input_nc=None, submodule=unet_block, norm_layer=norm_layer, use_checkpoint=use_checkpoint)
+        self.model = create_unet_block(output_nc, ngf, input_nc=input_nc, submodule=unet_block, outermost=True, norm_layer=norm_layer)  # add the outermost layer
 
         # For imporoved model ...
         base = self.model.model[1]
@@ -48,35 +66,148 @@ class UnetGenerator(nn.Module):
             base.model[5] = Upsample(inc, outc)
             base = base.model[3]
 
-        # pdb.set_trace()
-        self.load_weights()
-
-    def load_weights(self, model_path="models/Anime2Sketch.pth"):
-        cdir = os.path.dirname(__file__)
-        checkpoint = model_path if cdir == "" else cdir + "/" + model_path
+        # stateless InstanceNorm2d has no weights, swap in the one pass var_mean version
+        for m in list(self.modules()):
+            for name, child in m.named_children():
+                if isinstance(child, nn.InstanceNorm2d) and not child.affine and not child.track_running_stats:
+                    setattr(m, name, FastInstanceNorm2d(child.eps))
+
+        # the first conv takes the [0, 1] input, (input - 0.5) * 2.0 is folded into it
+        downconv = self.model.model[0]
+        self.model.model[0] = InputScaleConv2d(downconv.in_channels, downconv.out_channels, downconv.kernel_size,
+                                               stride=downconv.stride, padding=downconv.padding,
+                                               bias=downconv.bias is not None)
+
+        self._load_weights(assign=True)
+        # NHWC weights let cudnn/onednn pick tensor core kernels without per-layer transposes
+        self.to(memory_format=torch.channels_last)
+        if use_ipex:
+            self.optimize_ipex()
+        if int8_calib_data is not None:
+            self.quantize(int8_calib_data)
+        if use_compile:
+            self.compile_inference()
+
+    def load_weights(self, model_path=_DEFAULT_WEIGHTS):
+        self._load_weights(model_path)
+
+    def _load_weights(self, model_path=_DEFAULT_WEIGHTS, assign=False):
+        """assign=True takes the mmapped checkpoint tensors as the parameters, only for the fresh
+        cpu model in __init__. Otherwise they are copied into the existing parameters, which keep
+        their device and memory format.
+        """
+        # relative paths are under this package directory
+        checkpoint = model_path if os.path.isabs(model_path) else os.path.join(os.path.dirname(__file__), model_path)
 
         if os.path.exists(checkpoint):
             print(f"Loading weight from {checkpoint} ...")
-            weight_state = torch.load(checkpoint)
+            # mmap the file, no read buffer. With assign there is no copy into init weights either,
+            # the 4D conv weights still get copied once by the channels_last conversion in __init__.
+            weight_state = torch.load(checkpoint, map_location="cpu", mmap=True, weights_only=True)
             # for normal weigth file
             # for key in list(weight_state.keys()):
             #     if 'module.' in key:
             #         weight_state[key.replace('module.', '')] = weight_state[key]
             #         del weight_state[key]
-            self.load_state_dict(weight_state)
+            self.load_state_dict(weight_state, strict=True, assign=assign)
         else:
             print("-" * 32, "Warnning", "-" * 32)
             print(f"Weight file '{checkpoint}' not exist !!!")
 
+    def optimize_ipex(self):
+        """Let Intel Extension for PyTorch prepack the weights for oneDNN bfloat16 kernels (AVX-512/AMX),
+        forward then runs under cpu bfloat16 autocast, so like use_amp the model can not be scripted.
+        """
+        if not torch.backends.mkldnn.is_available():
+            print("-" * 32, "Warnning", "-" * 32)
+            print("mkldnn is not available, skip ipex optimize !!!")
+            return
+        try:
+            import intel_extension_for_pytorch as ipex
+        except ImportError:
+            print("-" * 32, "Warnning", "-" * 32)
+            print("intel_extension_for_pytorch is not installed, skip ipex optimize !!!")
+            return
+
+        self.eval()
+        # ipex may hand back a new (FX folded) module, keep the returned one
+        self.model = ipex.optimize(self.model, dtype=torch.bfloat16)
+        self.use_amp = True
+
+    def quantize(self, calib_loader):
+        """Post training int8 quantization of self.model with FX graph mode (x86 backend, cpu only).
+        calib_loader yields input batches in [0, 1] like forward() takes, or tuples/lists such as
+        (input, target) whose first element is the input. Upsample blocks (GELU mlp, fixed-kernel
+        deconv) have no int8 kernels and stay float.
+        """
+        from torch.ao.quantization import get_default_qconfig_mapping
+        from torch.ao.quantization.fx.custom_config import PrepareCustomConfig
+        from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+        self.eval()
+        qconfig_mapping = get_default_qconfig_mapping("x86").set_object_type(Upsample, None)
+        prepare_config = PrepareCustomConfig().set_non_traceable_module_classes([Upsample])
+        calib_inputs = [(batch[0] if isinstance(batch, (tuple, list)) else batch).contiguous(memory_format=torch.channels_last)
+                        for batch in calib_loader]
+        if len(calib_inputs) == 0:
+            raise ValueError("calib_loader yields no batches, int8 calibration needs at least one")
+        # trace with grad enabled so blocks record the plain torch.cat skip connections
+        with torch.enable_grad():
+            model = prepare_fx(self.model, qconfig_mapping, example_inputs=(calib_inputs[0],),
+                               prepare_custom_config=prepare_config)
+        with torch.no_grad():
+            for input in calib_inputs:
+                model(input)
+        self.model = convert_fx(model)
+
+    def export_onnx(self, shape=(1, 3, 512, 512), path="anime2sketch.onnx"):
+        """Export to ONNX with dynamic batch and image size, e.g. for TensorRT:
+            trtexec --onnx=anime2sketch.onnx --fp16 --saveEngine=anime2sketch.plan
+        """
+        self.eval()
+        x = torch.rand(shape, device=next(self.parameters()).device)
+        # stay on the TorchScript based exporter, newer torch defaults to dynamo
+        kwargs = {"dynamo": False} if "dynamo" in inspect.signature(torch.onnx.export).parameters else {}
+        with torch.no_grad():
+            torch.onnx.export(self, x, path, opset_version=17, input_names=["x"], output_names=["y"],
+                              dynamic_axes={"x": {0: "N", 2: "H", 3: "W"}, "y": {0: "N", 2: "H", 3: "W"}}, **kwargs)
+
+    def compile_inference(self):
+        """Capture self.model as one graph for inference, the compiler fuses conv+bias+activation
+        and cudnn algos are picked ahead. Note: the result can not be scripted again by get_model().
+        """
+        self.eval()
+        self.model = torch.compile(self.model, mode="max-autotune", fullgraph=True)
+
+
+    def forward(self, input, raw: bool = False):
+        """Standard forward, raw=True returns the Tanh output in [-1, 1] without rescaling to [0, 1]"""
+        input = input.contiguous(memory_format=torch.channels_last)
+        if self.use_amp:
+            if torch.jit.is_scripting():
+                raise RuntimeError("use_amp runs under torch.autocast, which is not supported in a scripted model")
+            output = self.autocast_forward(input)
+        else:
+            output = self.model(input)
+        if raw:
+            return output
+
+        # output is a fresh tensor, rescale it in place unless autograd keeps it for Tanh backward
+        if output.requires_grad:
+            output = (output + 1.0).mul_(0.5)
+        else:
+            output = output.add_(1.0).mul_(0.5)
 
-    def forward(self, input):
-        """Standard forward"""
-        input = (input - 0.5) * 2.0
-        output = self.model(input)
-        output = (output + 1.0)/2.0
-        
         return output
 
+    @torch.jit.unused
+    def autocast_forward(self, input):
+        """Run unet under autocast, conv layers in half precision, the output is rescaled in float32"""
+        amp_dtype = torch.float16 if input.is_cuda else torch.bfloat16
+        with torch.autocast(device_type=input.device.type, dtype=amp_dtype):
+            output = self.model(input)
+        return output.float()
+
 
 class UnetSkipConnectionBlock(nn.Module):
     """Defines the Unet submodule with skip connection.
@@ -85,7 +216,8 @@ class UnetSkipConnectionBlock(nn.Module):
     """
 
     def __init__(self, outer_nc, inner_nc, input_nc=None,
-                 submodule=None, outermost=False, innermost=False, norm_layer=nn.BatchNorm2d, use_dropout=False):
+                 submodule=None, outermost=False, innermost=False, norm_layer=nn.BatchNorm2d, use_dropout=False,
+                 use_checkpoint=False):
         """Construct a Unet submodule with skip connections.
         Parameters:
             outer_nc (int) -- the number of filters in the outer conv layer
@@ -96,9 +228,11 @@ class UnetSkipConnectionBlock(nn.Module):
             innermost (bool)    -- if this module is the innermost module
             norm_layer          -- normalization layer
             use_dropout (bool)  -- if use dropout layers.
+            use_checkpoint (bool) -- if recompute this block on backward in training mode
         """
         super(UnetSkipConnectionBlock, self).__init__()
         self.outermost = outermost
+        self.use_checkpoint = use_checkpoint
         if type(norm_layer) == functools.partial:
             use_bias = norm_layer.func == nn.InstanceNorm2d
         else:
@@ -138,42 +272,152 @@ class UnetSkipConnectionBlock(nn.Module):
             else:
                 model = down + [submodule] + up
 
+        # A stateless trailing norm is applied by forward() as a plain _instance_norm() call, so at inference
+        # it can write straight into the skip connection output. It has no state, sequential indices and
+        # weight keys are unchanged.
+        self.upnorm_eps: Optional[float] = None
+        if not outermost and not use_dropout and isinstance(upnorm, nn.InstanceNorm2d) \
+                and not upnorm.affine and not upnorm.track_running_stats:
+            self.upnorm_eps = model.pop().eps
+
         self.model = nn.Sequential(*model)
 
     def forward(self, x):
         if self.outermost:
             return self.model(x)
-        else:   # add skip connections
+        return self.skip_forward(x)
+
+    def skip_forward(self, x):
+        """Submodule output concatenated after x"""
+        if self.use_checkpoint and self.training:
+            return self.checkpoint_forward(x)
+        eps = self.upnorm_eps
+        if eps is None:   # add skip connections
             return torch.cat([x, self.model(x)], 1)
 
+        y = self.model(x)  # NOTE: the leading in-place LeakyReLU also activates x for the skip
+        # autograd, tracing and torch.compile (no out= on a strided view) take the plain torch.cat
+        if torch.is_grad_enabled() or torch.jit.is_tracing() or torch.compiler.is_compiling():
+            return torch.cat([x, _instance_norm(y, eps)], 1)
+
+        # skip connections without torch.cat, normalized y is written into its half of the output
+        c, sub_c = x.size(1), y.size(1)
+        out = torch.empty([x.size(0), c + sub_c, x.size(2), x.size(3)], dtype=y.dtype, device=y.device,
+                          memory_format=torch.channels_last)
+        out.narrow(1, 0, c).copy_(x)
+        _instance_norm(y, eps, out=out.narrow(1, c, sub_c))
+        return out
+
+    @torch.jit.unused
+    def checkpoint_forward(self, x):
+        """Keep no activations of the submodule, recompute them on backward.
+        x must stay untouched for the recompute, so the in-place LeakyReLU runs on a copy
+        inside the checkpoint and the skip gets an out-of-place one.
+        """
+        def submodule_forward(t):
+            y = self.model(t.clone())
+            return y if self.upnorm_eps is None else _instance_norm(y, self.upnorm_eps)
+
+        y = checkpoint(submodule_forward, x, use_reentrant=False)
+        return torch.cat([F.leaky_relu(x, self.model[0].negative_slope), y], 1)
+
+
+class OutermostBlock(UnetSkipConnectionBlock):
+    """Outermost unet block, no skip connection around it"""
+
+    def forward(self, x):
+        return self.model(x)
+
+
+class IntermediateBlock(UnetSkipConnectionBlock):
+    """Unet block with a submodule and a skip connection"""
+
+    def forward(self, x):
+        return self.skip_forward(x)
+
+
+class InnermostBlock(UnetSkipConnectionBlock):
+    """Bottleneck unet block, skip connection without a submodule"""
+
+    def forward(self, x):
+        return self.skip_forward(x)
+
+
+def create_unet_block(outer_nc, inner_nc, input_nc=None, submodule=None, outermost=False, innermost=False, **kwargs):
+    """Create the UnetSkipConnectionBlock subclass for the block position, so forward() needs no
+    outermost/innermost branch. Arguments are the same as UnetSkipConnectionBlock.
+    """
+    if outermost:
+        block_class = OutermostBlock
+    elif innermost:
+        block_class = InnermostBlock
+    else:
+        block_class = IntermediateBlock
+    return block_class(outer_nc, inner_nc, input_nc=input_nc, submodule=submodule,
+                       outermost=outermost, innermost=innermost, **kwargs)
+
+
+class InputScaleConv2d(nn.Conv2d):
+    """Conv2d of (x - 0.5) * 2.0 that takes x in [0, 1]. The scaling is folded into weight and bias
+    on each call, w' = 2 * w, b' = b - sum(w), and the zero padding of the scaled input becomes
+    padding x with 0.5. Parameters stay as trained, so state_dict matches the checkpoint.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.input_pad = [self.padding[1], self.padding[1], self.padding[0], self.padding[0]]
+
+    def forward(self, x):
+        x = F.pad(x, self.input_pad, value=0.5)
+        shift = self.weight.sum(dim=[1, 2, 3])
+        bias = self.bias
+        bias = -shift if bias is None else bias - shift
+        return F.conv2d(x, self.weight * 2.0, bias, self.stride, [0, 0], self.dilation, self.groups)
+
+
+class FastInstanceNorm2d(nn.Module):
+    """InstanceNorm2d(affine=False, track_running_stats=False), mean and var from one torch.var_mean pass"""
+
+    def __init__(self, eps=1e-5):
+        super().__init__()
+        self.eps = eps
+
+    def forward(self, x):
+        return _instance_norm(x, self.eps)
+
+
+def _instance_norm(x, eps: float, out: Optional[torch.Tensor] = None):
+    """FastInstanceNorm2d as a function, out -- optional destination, e.g. a slice of a larger buffer"""
+    var, mean = torch.var_mean(x, dim=[2, 3], keepdim=True, unbiased=False)
+    if out is None:
+        return (x - mean) * torch.rsqrt(var + eps)
+    torch.sub(x, mean, out=out)
+    return out.mul_(torch.rsqrt(var + eps))
+
 
 class Smooth(nn.Module):
     def __init__(self):
         super().__init__()
-        kernel = [
-            [1, 2, 1],
-            [2, 4, 2],
-            [1, 2, 1]
-        ]
-        kernel = torch.tensor([[kernel]], dtype=torch.float)
-        kernel /= kernel.sum()
-        self.register_buffer('kernel', kernel)
-        self.pad = nn.ReplicationPad2d(1)
+        self.register_buffer('kernel', _SMOOTH_KERNEL.clone())
 
     def forward(self, x):
-        b, c, h, w = x.shape
-        x = x.view(-1, 1, h, w)
-        x = self.pad(x)
-        x = F.conv2d(x, self.kernel)
-        return x.view(b, c, h, w)
+        # depthwise conv, no (b*c, 1, h, w) reshape. nn.Conv2d(padding_mode='replicate') pads the same way
+        # internally, so a functional pad is as cheap and keeps 'kernel' as the checkpoint key
+        c = x.size(1)
+        x = F.pad(x, [1, 1, 1, 1], mode='replicate')
+        return F.conv2d(x, self.kernel.expand(c, 1, 3, 3), groups=c)
         
 
 class Upsample(nn.Module):
     def __init__(self, inc, outc, scale_factor=2):
         super().__init__()
         self.scale_factor = scale_factor
+        self.inc = inc
         self.up = nn.Upsample(scale_factor=scale_factor, mode='bilinear')
         self.smooth = Smooth()
+        # upsample + smooth as one depthwise deconv, kernel stored per channel so its shape is
+        # static (needed by onnx export)
+        self.register_buffer('up_kernel', _UPSAMPLE_KERNEL.repeat(inc, 1, 1, 1), persistent=False)
         self.conv = nn.Conv2d(inc, outc, kernel_size=3, stride=1, padding=1)
         self.mlp = nn.Sequential(
             nn.Conv2d(outc, 4 * outc, kernel_size=1, stride=1, padding=0),
@@ -182,7 +426,12 @@ class Upsample(nn.Module):
         )
 
     def forward(self, x):
-        x = self.smooth(self.up(x))
+        if self.scale_factor == 2:
+            # replicate pad reproduces the edge clamping of bilinear and the pad of smooth exactly
+            x = F.pad(x, [1, 1, 1, 1], mode='replicate')
+            x = F.conv_transpose2d(x, self.up_kernel, stride=2, padding=4, groups=self.inc)
+        else:
+            x = self.smooth(self.up(x))
         x = self.conv(x)
         x = self.mlp(x) + x
         return x
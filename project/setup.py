@@ -36,7 +36,7 @@ setup(
         "Operating System :: OS Independent",
     ],
     install_requires=[
-        "torch >= 1.9.0",
+        "torch >= 2.3.0",
         "torchvision >= 0.10.0",
         "Pillow >= 7.2.0",
         "numpy >= 1.19.5",